@@ -27,6 +27,9 @@ CHROMA_COLLECTION: str   = os.getenv("CHROMA_COLLECTION", "gujarat_docs")
 # ── Conversation persistence (JSON file-based, swap for CosmosDB in prod) ────
 CONVERSATIONS_DIR: str = os.getenv("CONVERSATIONS_DIR", "conversation_store")
 
+# ── User store (SQLite by default; REDIS_URL shares it across workers) ───────
+REDIS_URL: str = os.getenv("REDIS_URL", "")
+
 # ── JWT Auth ─────────────────────────────────────────────────────────────────
 JWT_SECRET_KEY: str        = os.getenv("JWT_SECRET_KEY", "change-me-in-production")
 JWT_ALGORITHM: str         = "HS256"
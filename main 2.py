@@ -15,6 +15,7 @@ import os
 import sys
 from contextlib import asynccontextmanager
 
+import anyio.to_thread
 from dotenv import load_dotenv
 load_dotenv()   # load .env BEFORE importing anything that reads config
 
@@ -23,6 +24,7 @@ from fastapi.middleware.cors import CORSMiddleware
 
 from routers.auth import router as auth_router
 from routers.chat import router as chat_router
+from services.user_store import warm_up_kdf
 from services.vector_service import build_or_load_vectorstore
 
 
@@ -49,11 +51,21 @@ def validate_env():
         sys.exit(1)
 
 
+# ── Threadpool size ───────────────────────────────────────────────────────────
+# Password hashing/verification and sync endpoints run in anyio's default
+# threadpool (40 by default). Raise it so concurrent logins don't queue up.
+THREADPOOL_SIZE = int(os.getenv("THREADPOOL_SIZE", "64"))
+
+
 # ── Lifespan (startup / shutdown) ─────────────────────────────────────────────
 @asynccontextmanager
 async def lifespan(app: FastAPI):
     validate_env()
     print("[startup] ✅ Environment variables loaded.")
+    anyio.to_thread.current_default_thread_limiter().total_tokens = THREADPOOL_SIZE
+    print(f"[startup] ✅ Threadpool size set to {THREADPOOL_SIZE}.")
+    await anyio.to_thread.run_sync(warm_up_kdf)
+    print("[startup] ✅ Password hashing backend warmed up.")
     print("[startup] Loading vectorstore...")
     app.state.vectorstore = build_or_load_vectorstore()
     print("[startup] ✅ Vectorstore ready. Server accepting requests.")
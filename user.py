@@ -2,8 +2,11 @@
 models/user.py
 ==============
 Pydantic request/response schemas for auth endpoints.
+
+Emails are lower-cased on parse so "Foo@x.com" and "foo@x.com" are the same
+account and user_store lookups always hit the stored key.
 """
-from pydantic import BaseModel, EmailStr
+from pydantic import BaseModel, EmailStr, field_validator
 
 
 class RegisterRequest(BaseModel):
@@ -11,11 +14,21 @@ class RegisterRequest(BaseModel):
     email: EmailStr
     password: str
 
+    @field_validator("email")
+    @classmethod
+    def _lower_email(cls, v: str) -> str:
+        return v.lower()
+
 
 class LoginRequest(BaseModel):
     email: EmailStr
     password: str
 
+    @field_validator("email")
+    @classmethod
+    def _lower_email(cls, v: str) -> str:
+        return v.lower()
+
 
 class TokenResponse(BaseModel):
     access_token: str
@@ -1,58 +1,596 @@
 """
 services/user_store.py
 =======================
-Simple JSON-based user registry (swap for CosmosDB/Postgres in production).
+Simple user registry (swap for CosmosDB/Postgres in production).
 
-Stores: { email → { user_id, name, hashed_password } }
+Backends:
+  SQLite (default) — users(email PRIMARY KEY, user_id, name, hashed_password)
+  Redis (REDIS_URL set) — one hash per user, shared by every uvicorn worker:
+      user:<email>   → { user_id, name, hashed_password }
+      users:index    → SET of all emails
+      users:by_id    → HASH user_id → email
+
+Async variants (aregister_user / aauthenticate_user) run the DB access and the
+password KDF in anyio's default threadpool (the one FastAPI uses) so the event
+loop never blocks.
 """
-import json
+import asyncio
+import hashlib
 import os
-from typing import Optional
+import sqlite3
+import threading
+from typing import List, Optional, Tuple
+
+import anyio.to_thread
+import orjson
+from cachetools import TTLCache
 
+from core.config import REDIS_URL
 from core.security import hash_password, verify_password, new_user_id
 
-_USER_DB_FILE = "user_store/users.json"
+_USER_DB_FILE = "user_store/users.db"
+_LEGACY_JSON_FILE = "user_store/users.json"   # pre-SQLite format, imported once
 
+_REDIS_USER_PREFIX = "user:"
+_REDIS_INDEX_KEY = "users:index"
+_REDIS_BY_ID_KEY = "users:by_id"
+
+# Claim + fill a user hash in one atomic step, so a crash can never leave a
+# half-written user:<email>. A hash without hashed_password (left by an older,
+# non-atomic register) counts as free and is overwritten.
+# KEYS: user:<email>, users:index, users:by_id   ARGV: email, user_id, name, hashed
+_REDIS_REGISTER_LUA = """
+if redis.call('HEXISTS', KEYS[1], 'hashed_password') == 1 then
+    return 0
+end
+redis.call('HSET', KEYS[1], 'user_id', ARGV[2], 'name', ARGV[3], 'hashed_password', ARGV[4])
+redis.call('SADD', KEYS[2], ARGV[1])
+redis.call('HSET', KEYS[3], ARGV[2], ARGV[1])
+return 1
+"""
 
-def _load() -> dict:
+# Short-lived cache so a burst of repeat logins pays for one KDF.
+# Keyed by sha256(email:password) — raw passwords are never stored.
+# With Redis it lives under auth:<hex sha> (SETEX) so every worker shares hits;
+# otherwise it is a per-process TTLCache.
+_REDIS_AUTH_PREFIX = "auth:"
+_AUTH_CACHE_TTL_SECONDS = 60
+_auth_cache: TTLCache = TTLCache(maxsize=1024, ttl=_AUTH_CACHE_TTL_SECONDS)
+_cache_lock = threading.Lock()
+
+
+def _connect() -> sqlite3.Connection:
     os.makedirs(os.path.dirname(_USER_DB_FILE), exist_ok=True)
-    if not os.path.exists(_USER_DB_FILE):
-        return {}
-    with open(_USER_DB_FILE, "r", encoding="utf-8") as f:
-        return json.load(f)
+    conn = sqlite3.connect(_USER_DB_FILE, check_same_thread=False)
+    conn.row_factory = sqlite3.Row
+    # WAL: a commit is one append + one fsync of the -wal file (no rewrite of
+    # the DB, no rollback-journal dance), and a crash mid-write can never
+    # corrupt users.db. synchronous stays at the default FULL so a user told
+    # "registered" survives a power loss — registration is rare, so relaxing
+    # it to NORMAL (fsync only at checkpoints) would buy nothing.
+    conn.execute("PRAGMA journal_mode=WAL")
+    conn.execute(
+        "CREATE TABLE IF NOT EXISTS users ("
+        "  email           TEXT PRIMARY KEY,"
+        "  user_id         TEXT NOT NULL,"
+        "  name            TEXT NOT NULL,"
+        "  hashed_password TEXT NOT NULL"
+        ")"
+    )
+    conn.commit()
+    _import_legacy_json(conn)
+    _lowercase_existing_emails(conn)
+    return conn
+
+
+def _lowercase_existing_emails(conn: sqlite3.Connection) -> None:
+    """
+    Emails are stored lower-cased. Rows written before that are rewritten in
+    place. A row whose lower-cased email already exists is left untouched
+    rather than dropped — it can no longer be logged into, so it is reported
+    for an operator to merge or delete by hand.
+    """
+    with conn:
+        cur = conn.execute(
+            "UPDATE OR IGNORE users SET email = lower(email) WHERE email != lower(email)"
+        )
+        orphans = [
+            row["email"]
+            for row in conn.execute("SELECT email FROM users WHERE email != lower(email)")
+        ]
+    if cur.rowcount:
+        print(f"[user_store] Lower-cased {cur.rowcount} stored email(s)")
+    if orphans:
+        print(
+            f"[user_store] ⚠️  {len(orphans)} account(s) left mixed-case because the "
+            f"lower-cased email is already taken (unreachable until fixed): {orphans}"
+        )
+
+
+def _connect_redis():
+    import redis    # only needed when REDIS_URL is configured
+    client = redis.Redis.from_url(REDIS_URL, decode_responses=True)
+    return client, client.register_script(_REDIS_REGISTER_LUA)
+
+
+def _import_legacy_json(conn: sqlite3.Connection) -> None:
+    """
+    One-time import of the old { email → { user_id, name, hashed_password } }
+    users.json, then rename it so later startups skip the read entirely.
+
+    Emails are lower-cased on the way in. A record whose lower-cased email is
+    already held by a DIFFERENT user_id (e.g. "Foo@x.com" and "foo@x.com" in
+    the same file) is not dropped: it is written to users.json.conflicts for an
+    operator to resolve.
+
+    With several uvicorn workers starting at once, BEGIN IMMEDIATE lets only
+    one of them import at a time; the others re-check for the file inside the
+    transaction and find it already gone (or find every row already imported).
+    """
+    if not os.path.exists(_LEGACY_JSON_FILE):
+        return
+    imported, conflicts = 0, {}
+    with conn:
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            with open(_LEGACY_JSON_FILE, "rb") as f:
+                db = orjson.loads(f.read())
+        except FileNotFoundError:
+            return                  # another worker finished the import first
+        for email, rec in db.items():
+            key = email.strip().lower()
+            cur = conn.execute(
+                "INSERT OR IGNORE INTO users (email, user_id, name, hashed_password) "
+                "VALUES (?, ?, ?, ?)",
+                (key, rec["user_id"], rec["name"], rec["hashed_password"]),
+            )
+            if cur.rowcount:
+                imported += 1
+                continue
+            existing = conn.execute(
+                "SELECT user_id FROM users WHERE email = ?", (key,)
+            ).fetchone()
+            if existing["user_id"] != rec["user_id"]:
+                conflicts[email] = rec
+    if conflicts:
+        with open(_LEGACY_JSON_FILE + ".conflicts", "wb") as f:
+            f.write(orjson.dumps(conflicts, option=orjson.OPT_INDENT_2))
+    try:
+        os.replace(_LEGACY_JSON_FILE, _LEGACY_JSON_FILE + ".migrated")
+    except FileNotFoundError:
+        return                      # another worker renamed it after our commit
+    print(f"[user_store] Imported {imported} of {len(db)} user(s) from {_LEGACY_JSON_FILE}")
+    if conflicts:
+        print(
+            f"[user_store] ⚠️  {len(conflicts)} user(s) collide with an existing email "
+            f"after lower-casing — kept in {_LEGACY_JSON_FILE}.conflicts"
+        )
+
+
+# Opened once at import. With Redis every worker shares one store and lookups
+# are sub-ms round-trips, so the in-memory copy below is SQLite-only (existing
+# SQLite / users.json accounts are imported into Redis on first start — see
+# _migrate_into_redis).
+# The SQLite connection is shared across threadpool workers, so every
+# statement / transaction on it runs under _db_lock (keeps one call's commit
+# from flushing or interleaving with another's). _db_lock also guards the
+# in-memory copy of the table below.
+_redis, _redis_register = _connect_redis() if REDIS_URL else (None, None)
+_conn = None if _redis is not None else _connect()
+_db_lock = threading.Lock()
+
+# Parsed users table { email → { user_id, name, hashed_password } }, loaded
+# lazily once and written through on register. Reads are a dict lookup.
+# _by_user_id is the reverse index { user_id → { user_id, name, email } } kept
+# in step — profile only, no password hash.
+_users: Optional[dict] = None
+_by_user_id: dict = {}
+_users_version: Optional[int] = None
+_users_max_rowid: int = 0
 
 
-def _save(db: dict) -> None:
-    with open(_USER_DB_FILE, "w", encoding="utf-8") as f:
-        json.dump(db, f, ensure_ascii=False, indent=2)
+def _profile(email: str, record: dict) -> dict:
+    return {"user_id": record["user_id"], "name": record["name"], "email": email}
+
+
+def _merge_rows(since_rowid: int) -> None:
+    """Merge users rows with rowid > since_rowid into both in-memory maps."""
+    global _users_max_rowid
+    rows = _conn.execute(
+        "SELECT rowid, email, user_id, name, hashed_password FROM users WHERE rowid > ?",
+        (since_rowid,),
+    ).fetchall()
+    for row in rows:
+        rec = {
+            "user_id":         row["user_id"],
+            "name":            row["name"],
+            "hashed_password": row["hashed_password"],
+        }
+        _users[row["email"]] = rec
+        _by_user_id[rec["user_id"]] = _profile(row["email"], rec)
+        _users_max_rowid = max(_users_max_rowid, row["rowid"])
+
+
+def _db() -> dict:
+    """
+    Return the in-memory users map. Caller must hold _db_lock.
+
+    PRAGMA data_version only changes when ANOTHER connection commits (e.g. a
+    second uvicorn worker registering a user), so our own write-through never
+    triggers a refresh, but other processes' inserts are still picked up.
+    The table is insert-only after startup, so a refresh only reads rows past
+    the highest rowid seen; the full reload is kept for the first load and for
+    the (unexpected) case where the row count no longer matches.
+    """
+    global _users, _by_user_id, _users_version, _users_max_rowid
+    version = _conn.execute("PRAGMA data_version").fetchone()[0]
+    if _users is not None and version == _users_version:
+        return _users
+
+    if _users is not None:
+        _merge_rows(_users_max_rowid)
+        count = _conn.execute("SELECT count(*) FROM users").fetchone()[0]
+        if count == len(_users):
+            _users_version = version
+            return _users
+
+    _users, _by_user_id, _users_max_rowid = {}, {}, 0
+    _merge_rows(0)
+    _users_version = version
+    return _users
+
+
+def _insert_sqlite(name: str, email: str, user_id: str, hashed: str) -> Optional[str]:
+    with _db_lock:
+        db = _db()
+        with _conn:
+            row = _conn.execute(
+                "INSERT INTO users (email, user_id, name, hashed_password) "
+                "VALUES (?, ?, ?, ?) "
+                "ON CONFLICT(email) DO NOTHING "
+                "RETURNING user_id",
+                (email, user_id, name, hashed),
+            ).fetchone()
+        if row is None:
+            return None             # email already registered
+        db[email] = {
+            "user_id":         user_id,
+            "name":            name,
+            "hashed_password": hashed,
+        }
+        _by_user_id[user_id] = _profile(email, db[email])
+    return user_id
+
+
+def _redis_register_args(name: str, email: str, user_id: str, hashed: str) -> dict:
+    return {
+        "keys": [_REDIS_USER_PREFIX + email, _REDIS_INDEX_KEY, _REDIS_BY_ID_KEY],
+        "args": [email, user_id, name, hashed],
+    }
+
+
+def _insert_redis(name: str, email: str, user_id: str, hashed: str) -> Optional[str]:
+    # The script is the atomic "email already taken" check across all workers
+    if not _redis_register(**_redis_register_args(name, email, user_id, hashed)):
+        return None                 # email already registered
+    return user_id
+
+
+def _existing_emails(emails: List[str]) -> set:
+    """Subset of emails already registered — one lock / one pipeline for the lot."""
+    if _redis is not None:
+        pipe = _redis.pipeline()
+        for email in emails:
+            pipe.hexists(_REDIS_USER_PREFIX + email, "hashed_password")
+        return {email for email, n in zip(emails, pipe.execute()) if n}
+    with _db_lock:
+        db = _db()
+        return {email for email in emails if email in db}
+
+
+def _insert_many_sqlite(rows: List[Tuple[str, str, str, str]]) -> List[str]:
+    """Insert (name, email, user_id, hashed) rows in ONE transaction; returns emails written."""
+    with _db_lock:
+        with _conn:
+            # IMMEDIATE takes the write lock up front, so no other worker can
+            # insert one of these emails between our check and our insert.
+            _conn.execute("BEGIN IMMEDIATE")
+            db = _db()
+            fresh = [r for r in rows if r[1] not in db]
+            _conn.executemany(
+                "INSERT INTO users (email, user_id, name, hashed_password) "
+                "VALUES (?, ?, ?, ?)",
+                [(email, user_id, name, hashed) for name, email, user_id, hashed in fresh],
+            )
+        for name, email, user_id, hashed in fresh:
+            db[email] = {
+                "user_id":         user_id,
+                "name":            name,
+                "hashed_password": hashed,
+            }
+            _by_user_id[user_id] = _profile(email, db[email])
+    return [r[1] for r in fresh]
+
+
+def _insert_many_redis(rows: List[Tuple[str, str, str, str]]) -> List[str]:
+    """Register (name, email, user_id, hashed) rows in one pipelined round-trip; returns emails written."""
+    pipe = _redis.pipeline()
+    for row in rows:
+        _redis_register(**_redis_register_args(*row), client=pipe)
+    return [row[1] for row, ok in zip(rows, pipe.execute()) if ok]
 
 
 def register_user(name: str, email: str, password: str) -> Optional[str]:
     """
     Create a new user. Returns the new user_id, or None if email already taken.
     """
-    db = _load()
-    if email in db:
+    email = _normalize_email(email)
+    # Cheap keyed check first so a duplicate email never pays for the KDF;
+    # the backend insert still guards against a concurrent register.
+    if _get_record(email) is not None:
         return None                 # email already registered
 
-    user_id = new_user_id()
-    db[email] = {
-        "user_id":         user_id,
-        "name":            name,
-        "hashed_password": hash_password(password),
-    }
-    _save(db)
-    return user_id
+    hashed = hash_password(password)    # slow KDF — never hold _db_lock for it
+    if _redis is not None:
+        return _insert_redis(name, email, new_user_id(), hashed)
+    return _insert_sqlite(name, email, new_user_id(), hashed)
+
+
+def _get_record_redis(email: str) -> Optional[dict]:
+    record = _redis.hgetall(_REDIS_USER_PREFIX + email)
+    # A hash without hashed_password is a leftover partial claim — not a user
+    if "hashed_password" not in record:
+        return None
+    return record
+
+
+def _migrate_sqlite_into_redis() -> None:
+    """
+    Copy every SQLite user (after _connect() has imported any legacy
+    users.json and lower-cased emails) into Redis in one pipeline, then rename
+    users.db so later startups skip it. Mixed-case orphans reported by
+    _lowercase_existing_emails are left behind in users.db.migrated.
+    """
+    conn = _connect()
+    rows = [
+        (row["name"], row["email"], row["user_id"], row["hashed_password"])
+        for row in conn.execute(
+            "SELECT email, user_id, name, hashed_password FROM users "
+            "WHERE email = lower(email)"
+        )
+    ]
+    conn.close()
+
+    written = set(_insert_many_redis(rows))
+    skipped = [row for row in rows if row[1] not in written]
+    conflicts = []
+    if skipped:
+        pipe = _redis.pipeline()
+        for _, email, _, _ in skipped:
+            pipe.hget(_REDIS_USER_PREFIX + email, "user_id")
+        # Same user_id = imported by an earlier, interrupted run — not a conflict
+        conflicts = [
+            row[1] for row, user_id in zip(skipped, pipe.execute()) if user_id != row[2]
+        ]
+    os.replace(_USER_DB_FILE, _USER_DB_FILE + ".migrated")
+    print(f"[user_store] Imported {len(written)} of {len(rows)} user(s) from {_USER_DB_FILE} into Redis")
+    if conflicts:
+        print(
+            f"[user_store] ⚠️  {len(conflicts)} user(s) already registered in Redis under a "
+            f"different user_id — kept in {_USER_DB_FILE}.migrated: {conflicts}"
+        )
+
+
+def _lowercase_redis_emails() -> None:
+    """
+    Re-key user:<Email> hashes written before emails were normalized. A hash
+    whose lower-cased email is already taken by another user is left in place
+    and reported, like _lowercase_existing_emails does for SQLite.
+    """
+    moved, orphans = 0, []
+    for email in sorted(_redis.smembers(_REDIS_INDEX_KEY)):
+        lower = email.lower()
+        if email == lower:
+            continue
+        record = _get_record_redis(email)
+        if record:
+            existing = _get_record_redis(lower)
+            if existing is None:
+                _redis_register(**_redis_register_args(
+                    record["name"], lower, record["user_id"], record["hashed_password"]
+                ))
+            elif existing["user_id"] != record["user_id"]:
+                orphans.append(email)
+                continue
+        pipe = _redis.pipeline()
+        pipe.delete(_REDIS_USER_PREFIX + email)
+        pipe.srem(_REDIS_INDEX_KEY, email)
+        pipe.execute()
+        moved += 1
+    if moved:
+        print(f"[user_store] Lower-cased {moved} stored email(s) in Redis")
+    if orphans:
+        print(
+            f"[user_store] ⚠️  {len(orphans)} account(s) left mixed-case because the "
+            f"lower-cased email is already taken (unreachable until fixed): {orphans}"
+        )
+
+
+def _migrate_into_redis() -> None:
+    """
+    Bring existing accounts over the first time REDIS_URL is enabled, so
+    switching backends never locks anyone out. A Redis lock serializes uvicorn
+    workers starting together; each re-checks for the files inside it.
+    """
+    with _redis.lock("users:migrate_lock", timeout=300, blocking_timeout=300):
+        if os.path.exists(_USER_DB_FILE) or os.path.exists(_LEGACY_JSON_FILE):
+            _migrate_sqlite_into_redis()
+        _lowercase_redis_emails()
+
+
+if _redis is not None:
+    _migrate_into_redis()
+
+
+def _get_record(email: str) -> Optional[dict]:
+    """Fetch a copy of { user_id, name, hashed_password } for an email, or None."""
+    if _redis is not None:
+        return _get_record_redis(email)
+    with _db_lock:
+        record = _db().get(email)
+    # Copy: callers must never be able to mutate the in-memory table
+    return dict(record) if record else None
+
+
+def get_by_user_id(user_id: str) -> Optional[dict]:
+    """
+    Look up a user's profile by user_id. Returns { user_id, name, email } or None.
+    Credentials (hashed_password) are never included.
+    """
+    if _redis is not None:
+        email = _redis.hget(_REDIS_BY_ID_KEY, user_id)
+        record = _get_record_redis(email) if email else None
+        return _profile(email, record) if record else None
+    with _db_lock:
+        _db()
+        profile = _by_user_id.get(user_id)
+    return dict(profile) if profile else None
+
+
+def warm_up_kdf() -> None:
+    """
+    Run one hash + verify so the KDF backend is loaded before the first real
+    request. passlib resolves and self-tests its bcrypt backend lazily on first
+    use, which would otherwise land on whichever user logs in first. Call once
+    per process at startup (off the event loop).
+    """
+    verify_password("warm-up", hash_password("warm-up"))
+
+
+def _normalize_email(email: str) -> str:
+    """Stored key form — models.user already lower-cases, this covers direct callers."""
+    return email.strip().lower()
+
+
+def _auth_key(email: str, password: str) -> bytes:
+    return hashlib.sha256(f"{email}:{password}".encode("utf-8")).digest()
+
+
+def _auth_cache_lookup(email: str, password: str) -> Tuple[str, bytes, Optional[dict]]:
+    """Normalize the email and check the credential cache. Returns (email, key, cached record)."""
+    email = _normalize_email(email)
+    key = _auth_key(email, password)
+    if _redis is not None:
+        cached = _redis.get(_REDIS_AUTH_PREFIX + key.hex())
+        return email, key, orjson.loads(cached) if cached else None
+    with _cache_lock:
+        record = _auth_cache.get(key)
+    return email, key, dict(record) if record else None
+
+
+def _auth_cache_store(key: bytes, record: Optional[dict]) -> Optional[dict]:
+    """Cache a private copy of a verified record (None = failed login, not cached); returns it."""
+    if record is None:
+        return None
+    if _redis is not None:
+        _redis.setex(_REDIS_AUTH_PREFIX + key.hex(), _AUTH_CACHE_TTL_SECONDS, orjson.dumps(record))
+        return record
+    with _cache_lock:
+        _auth_cache[key] = dict(record)
+    return record
 
 
 def authenticate_user(email: str, password: str) -> Optional[dict]:
     """
     Verify credentials. Returns user record dict or None if invalid.
     """
-    db = _load()
-    record = db.get(email)
-    if not record:
-        return None
-    if not verify_password(password, record["hashed_password"]):
-        return None
-    return record   # { user_id, name, hashed_password }
+    email, key, record = _auth_cache_lookup(email, password)
+    if record is not None:
+        return record
+
+    record = _get_record(email)
+    ok = bool(record) and verify_password(password, record["hashed_password"])
+    return _auth_cache_store(key, record if ok else None)   # { user_id, name, hashed_password }
+
+
+async def aregister_user(name: str, email: str, password: str) -> Optional[str]:
+    """
+    Async register_user — hashing + insert run off the event loop.
+    """
+    return await anyio.to_thread.run_sync(register_user, name, email, password)
+
+
+async def aauthenticate_user(email: str, password: str) -> Optional[dict]:
+    """
+    Async authenticate_user — cache, record fetch and verify_password run off
+    the event loop (with Redis the cache itself is a network round-trip).
+    """
+    email, key, record = await anyio.to_thread.run_sync(_auth_cache_lookup, email, password)
+    if record is not None:
+        return record
+
+    record = await anyio.to_thread.run_sync(_get_record, email)
+    ok = bool(record) and await anyio.to_thread.run_sync(
+        verify_password, password, record["hashed_password"]
+    )
+    return await anyio.to_thread.run_sync(_auth_cache_store, key, record if ok else None)
+
+
+async def register_users_bulk(records: List[Tuple[str, str, str]]) -> List[Optional[str]]:
+    """
+    Register many (name, email, password) records at once, e.g. when seeding.
+    Returns a user_id per record (same order), or None where the email was
+    already taken or repeated earlier in the batch.
+
+    Passwords are hashed in parallel across the threadpool, then every insert
+    is committed together: one SQLite transaction, or one Redis pipeline.
+    """
+    records = [(name, _normalize_email(email), password) for name, email, password in records]
+
+    # Drop taken / repeated emails before paying for any KDF work
+    taken = await anyio.to_thread.run_sync(_existing_emails, [r[1] for r in records])
+    pending, seen = [], set(taken)
+    for name, email, password in records:
+        if email not in seen:
+            seen.add(email)
+            pending.append((name, email, password))
+
+    hashes = await asyncio.gather(
+        *[anyio.to_thread.run_sync(hash_password, password) for _, _, password in pending]
+    )
+    rows = [
+        (name, email, new_user_id(), hashed)
+        for (name, email, _), hashed in zip(pending, hashes)
+    ]
+    insert_many = _insert_many_redis if _redis is not None else _insert_many_sqlite
+    written = set(await anyio.to_thread.run_sync(insert_many, rows))
+
+    user_ids = {email: user_id for _, email, user_id, _ in rows if email in written}
+    results, returned = [], set()
+    for _, email, _ in records:
+        if email in user_ids and email not in returned:
+            results.append(user_ids[email])
+            returned.add(email)
+        else:
+            results.append(None)
+    return results
+
+
+def dump_debug(path: str = "user_store/users.debug.json") -> None:
+    """
+    Write a pretty-printed { email → { user_id, name } } snapshot for manual
+    inspection. Debug only — storage itself stays compact (SQLite / Redis).
+    """
+    if _redis is not None:
+        emails = sorted(_redis.smembers(_REDIS_INDEX_KEY))
+        records = {email: _get_record_redis(email) for email in emails}
+    else:
+        with _db_lock:
+            records = dict(_db())
+    snapshot = {
+        email: {"user_id": rec["user_id"], "name": rec["name"]}
+        for email, rec in records.items()
+        if rec
+    }
+    with open(path, "wb") as f:
+        f.write(orjson.dumps(snapshot, option=orjson.OPT_INDENT_2 | orjson.OPT_SORT_KEYS))